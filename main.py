@@ -3,15 +3,99 @@ import time
 import math
 import asyncio
 import threading
-from typing import Optional, Tuple, List, Dict, Any, Literal, Set
+from dataclasses import dataclass
+from typing import Optional, Tuple, List, Dict, Any, Literal
 
 from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import ORJSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.websockets import WebSocketState
 from pydantic import BaseModel
 
+import orjson
 from periphery import GPIO
-from pymodbus.client import ModbusSerialClient
+from pymodbus.client import AsyncModbusSerialClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+
+# =========================================================
+# Config (อ่าน env ครั้งเดียวตอน import)
+# =========================================================
+@dataclass(frozen=True)
+class Config:
+    static_dir: str
+
+    # Door + Limit
+    gpio_chip: str
+    line_open: int
+    line_close: int
+    default_pulse_ms: int
+    line_di1: int
+    di1_active_high: bool
+    di1_debounce_ms: int
+
+    # RS485 Modbus
+    serial_port: str
+    baudrate: int
+    parity: str
+    bytesize: int
+    stopbits: int
+    timeout_s: float
+    modbus_retries: int
+    read_table: str
+    reg_start: int
+    reg_count: int
+    temp_index: int
+    humi_index: int
+    scale_div: float
+    indoor_id: int
+    outdoor_id: int
+
+    # Realtime
+    poll_ms: int
+    ws_send_timeout_s: float
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        baudrate = int(os.getenv("BAUDRATE", "9600"))
+        reg_count = int(os.getenv("REG_COUNT", "2"))
+        # default timeout ตามความยาว frame ตอบกลับ (11 bit/char) + margin
+        # แทนการรอตายตัว 1 s ซึ่งนานเกินจำเป็นมากที่ 9600 baud
+        timeout_s = float(
+            os.getenv("TIMEOUT_S") or (3.5 * 11 / baudrate * (5 + 2 * reg_count) + 0.05)
+        )
+        return cls(
+            static_dir=os.getenv("STATIC_DIR", "static"),
+            gpio_chip=os.getenv("GPIO_CHIP", "/dev/gpiochip0"),
+            line_open=int(os.getenv("LINE_OPEN", "25")),  # DI0
+            line_close=int(os.getenv("LINE_CLOSE", "24")),  # DI1
+            default_pulse_ms=int(os.getenv("DEFAULT_PULSE_MS", "800")),
+            line_di1=int(os.getenv("LINE_DI1", "17")),
+            di1_active_high=os.getenv("DI1_ACTIVE_HIGH", "true").lower() == "true",
+            di1_debounce_ms=int(os.getenv("DI1_DEBOUNCE_MS", "50")),
+            serial_port=os.getenv("SERIAL_PORT", "/dev/ttyACM0"),
+            baudrate=baudrate,
+            parity=os.getenv("PARITY", "N"),
+            bytesize=int(os.getenv("BYTESIZE", "8")),
+            stopbits=int(os.getenv("STOPBITS", "1")),
+            timeout_s=timeout_s,
+            # default 0: pymodbus retry จับคู่ reply ด้วย TID 0 (RTU) -> reply ที่มาช้า
+            # ของครั้งก่อนอาจถูกนับเป็นของ request ใหม่/unit ถัดไป
+            modbus_retries=int(os.getenv("MODBUS_RETRIES", "0")),
+            read_table=os.getenv("READ_TABLE", "holding").lower(),  # holding | input
+            reg_start=int(os.getenv("REG_START", "0")),
+            reg_count=reg_count,
+            temp_index=int(os.getenv("TEMP_INDEX", "1")),
+            humi_index=int(os.getenv("HUMI_INDEX", "0")),
+            scale_div=float(os.getenv("SCALE_DIV", "10")),
+            indoor_id=int(os.getenv("INDOOR_ID", "1")),
+            outdoor_id=int(os.getenv("OUTDOOR_ID", "2")),
+            poll_ms=int(os.getenv("POLL_MS", "1000")),
+            ws_send_timeout_s=float(os.getenv("WS_SEND_TIMEOUT_S", "0.5")),
+        )
+
+
+CFG = Config.from_env()
 
 
 # =========================================================
@@ -19,20 +103,20 @@ from pymodbus.client import ModbusSerialClient
 # =========================================================
 app = FastAPI(
     title="NARIT CM LiDAR API (Door + Limit + RS485 Sensor)",
-    version="3.1"
+    version="3.1",
+    default_response_class=ORJSONResponse,
 )
 
 # =========================================================
 # Static (Sensor Web UI – ถ้ามี)
 # =========================================================
-STATIC_DIR = os.getenv("STATIC_DIR", "static")
-if os.path.isdir(STATIC_DIR):
-    app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+if os.path.isdir(CFG.static_dir):
+    app.mount("/static", StaticFiles(directory=CFG.static_dir), name="static")
 
 
 @app.get("/")
 def root():
-    index_path = os.path.join(STATIC_DIR, "index.html")
+    index_path = os.path.join(CFG.static_dir, "index.html")
     if os.path.isfile(index_path):
         return FileResponse(index_path)
     return {"ok": True, "service": "naritcm-lidar-api", "docs": "/docs"}
@@ -41,43 +125,55 @@ def root():
 # =========================================================
 # Health
 # =========================================================
+# body คงที่ encode ครั้งเดียว ส่งเป็น bytes ตรงๆ ไม่ผ่าน serializer ทุก request
+_HEALTH_BODY = orjson.dumps({"ok": True, "service": "naritcm-lidar-api", "version": app.version})
+
+
 @app.get("/health")
-def health():
-    return {"ok": True, "service": "naritcm-lidar-api", "version": "3.1"}
+async def health():
+    return Response(_HEALTH_BODY, media_type="application/json")
 
 
 # =========================================================
 # Door + Limit (เหมือน roof-control.py)
 # =========================================================
-GPIO_CHIP = os.getenv("GPIO_CHIP", "/dev/gpiochip0")
-
-LINE_OPEN  = int(os.getenv("LINE_OPEN",  "25")) # DI0
-LINE_CLOSE = int(os.getenv("LINE_CLOSE", "24")) # DI1
-DEFAULT_PULSE_MS = int(os.getenv("DEFAULT_PULSE_MS", "800"))
-
-LINE_DI1 = int(os.getenv("LINE_DI1", "17"))
-DI1_ACTIVE_HIGH = os.getenv("DI1_ACTIVE_HIGH", "true").lower() == "true"
-DI1_DEBOUNCE_MS = int(os.getenv("DI1_DEBOUNCE_MS", "50"))
+DoorState = Literal["idle", "opening", "closing", "holding_open", "holding_close"]
 
 
 class DOManager:
     def __init__(self, chip_path: str, line_open: int, line_close: int):
-        self.lock = threading.Lock()
-        self.state: Literal[
-            "idle", "opening", "closing", "holding_open", "holding_close"
-        ] = "idle"
+        # ทุกอย่างรันบน event loop เดียว และช่วงที่เปลี่ยน GPIO/state ไม่มี await
+        # -> ไม่โดน request อื่นแทรกกลางคัน ไม่ต้องมี lock
+        # pulse ที่กำลังทำงาน: คำสั่งใหม่ cancel ตัวเก่าแทนการเข้าคิวรอ
+        self._pulse_task: Optional[asyncio.Task] = None
+        self.state = "idle"
         self.gpio_open = GPIO(chip_path, line_open, "out")
         self.gpio_close = GPIO(chip_path, line_close, "out")
-        self.all_low()
+        self.gpio_open.write(False)
+        self.gpio_close.write(False)
+
+    @property
+    def state(self) -> DoorState:
+        return self._state
+
+    @state.setter
+    def state(self, value: DoorState):
+        # encode body ของ /door/status ใหม่เฉพาะตอน state เปลี่ยน
+        self._state = value
+        self.status_body = orjson.dumps({"ok": True, "status": {"state": value}})
 
     def all_low(self):
+        # เขียน low ทั้งสองเส้นทุกครั้ง: stop ต้องได้ผลเสมอ ไม่พึ่ง state ที่จำไว้
         self.gpio_open.write(False)
         self.gpio_close.write(False)
 
-    def pulse(self, target: Literal["open", "close"], ms: int):
-        if not (1 <= ms <= 5000):
-            raise ValueError("pulse ms must be 1..5000")
-        with self.lock:
+    async def _run_pulse(
+        self, prev: Optional[asyncio.Task], target: Literal["open", "close"], ms: int
+    ):
+        try:
+            # รอ pulse เก่าปล่อย line ให้เสร็จก่อน ค่อย drive ของเรา
+            if prev is not None:
+                await asyncio.wait({prev})
             self.all_low()
             if target == "open":
                 self.state = "opening"
@@ -85,54 +181,104 @@ class DOManager:
             else:
                 self.state = "closing"
                 self.gpio_close.write(True)
-        try:
-            time.sleep(ms / 1000.0)
+            await asyncio.sleep(ms / 1000.0)
         finally:
-            with self.lock:
-                self.all_low()
-                self.state = "idle"
-
-    def hold(self, target: Literal["open", "close"]):
-        with self.lock:
-            self.all_low()
-            if target == "open":
-                self.gpio_open.write(True)
-                self.state = "holding_open"
-            else:
-                self.gpio_close.write(True)
-                self.state = "holding_close"
-
-    def stop(self):
-        with self.lock:
+            # จบปกติหรือโดน cancel ก็ต้องกลับ low เสมอ (ไม่มี await -> ไม่โดนแทรก)
             self.all_low()
             self.state = "idle"
 
-    def status(self):
-        return {"state": self.state}
+    async def _cancel_pulse(self):
+        task = self._pulse_task
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+
+    async def pulse(self, target: Literal["open", "close"], ms: int) -> bool:
+        """คืน False ถ้า pulse นี้ถูกคำสั่งที่ตามมาทีหลัง cancel ไปก่อนครบเวลา"""
+        if not (1 <= ms <= 5000):
+            raise ValueError("pulse ms must be 1..5000")
+        prev = self._pulse_task
+        if prev is not None and not prev.done():
+            prev.cancel()
+        else:
+            prev = None
+        task = asyncio.create_task(self._run_pulse(prev, target, ms))
+        self._pulse_task = task
+        await asyncio.wait({task})
+        if task.cancelled():
+            return False
+        # GPIO error ใน task ต้องถึง handler (-> 500) ไม่ใช่เงียบเป็น ok
+        task.result()
+        return True
+
+    async def hold(self, target: Literal["open", "close"]):
+        await self._cancel_pulse()
+        self.all_low()
+        if target == "open":
+            self.gpio_open.write(True)
+            self.state = "holding_open"
+        else:
+            self.gpio_close.write(True)
+            self.state = "holding_close"
+
+    async def stop(self):
+        await self._cancel_pulse()
+        self.all_low()
+        self.state = "idle"
 
 
 class DIReader:
+    """
+    อ่าน DI แบบ edge-triggered: thread หลับใน kernel (gpio.poll) จนกว่าจะมี edge
+    แล้วรอให้ไม่มี edge ใหม่ครบ debounce ก่อน commit สถานะ
+    read() คืนค่าที่ debounce แล้วทันที ไม่ต้อง sleep บน request path
+    """
+
     def __init__(self, chip_path: str, line_no: int, active_high: bool, debounce_ms: int):
-        self.gpio = GPIO(chip_path, line_no, "in")
-        self.active_high = active_high
-        self.debounce_s = max(debounce_ms, 0) / 1000.0
+        # active-low ให้ kernel กลับค่าให้ (cdev inverted flag) ไม่ต้องกลับเองตอนอ่าน
+        self.gpio = GPIO(chip_path, line_no, "in", edge="both", inverted=not active_high)
+        self.debounce_ns = max(debounce_ms, 0) * 1_000_000
+        # เขียนจาก thread เดียว อ่านเป็นค่า int ค่าเดียว -> ไม่ต้องมี lock
+        self._stable = self.read_raw()
+        self._last_change = time.monotonic_ns()
+        self._thread = threading.Thread(target=self._loop, name="di-reader", daemon=True)
+        self._thread.start()
 
     def read_raw(self) -> int:
         return 1 if self.gpio.read() else 0
 
+    def _drain_events(self):
+        # cdev เก็บ edge event ค้างไว้ ต้อง read_event() ออกให้หมด
+        while self.gpio.poll(0):
+            self.gpio.read_event()
+
+    def _loop(self):
+        while True:
+            try:
+                if not self.gpio.poll(1.0):
+                    # ไม่มี edge: sync ระดับจริงเผื่อพลาด event
+                    self._stable = self.read_raw()
+                    continue
+
+                self._drain_events()
+                self._last_change = time.monotonic_ns()
+                while True:
+                    remaining_ns = self.debounce_ns - (time.monotonic_ns() - self._last_change)
+                    if remaining_ns <= 0 or not self.gpio.poll(remaining_ns / 1e9):
+                        break
+                    self._drain_events()
+                    self._last_change = time.monotonic_ns()
+
+                self._stable = self.read_raw()
+            except Exception:
+                time.sleep(1.0)
+
     def read(self) -> bool:
-        votes = 0
-        reads = 3
-        for _ in range(reads):
-            votes += self.read_raw()
-            if self.debounce_s:
-                time.sleep(self.debounce_s / reads)
-        raw_level = 1 if votes >= 2 else 0
-        return bool(raw_level if self.active_high else (1 - raw_level))
+        return bool(self._stable)
 
 
-manager = DOManager(GPIO_CHIP, LINE_OPEN, LINE_CLOSE)
-di1 = DIReader(GPIO_CHIP, LINE_DI1, DI1_ACTIVE_HIGH, DI1_DEBOUNCE_MS)
+manager = DOManager(CFG.gpio_chip, CFG.line_open, CFG.line_close)
+di1 = DIReader(CFG.gpio_chip, CFG.line_di1, CFG.di1_active_high, CFG.di1_debounce_ms)
 
 
 class PulseRequest(BaseModel):
@@ -140,61 +286,71 @@ class PulseRequest(BaseModel):
 
 
 @app.get("/door/status")
-def door_status():
-    return {"ok": True, "status": manager.status()}
+async def door_status():
+    return Response(manager.status_body, media_type="application/json")
 
 
 @app.post("/door/open")
-def door_open(
+async def door_open(
     body: Optional[PulseRequest] = None,
     ms: int = Query(None, ge=1, le=5000)
 ):
-    pulse_ms = ms or (body.ms if body and body.ms else None) or DEFAULT_PULSE_MS
+    pulse_ms = ms or (body.ms if body and body.ms else None) or CFG.default_pulse_ms
     try:
-        manager.pulse("open", pulse_ms)
-        return {"ok": True, "action": "open", "pulse_ms": pulse_ms}
+        done = await manager.pulse("open", pulse_ms)
+        return {"ok": True, "action": "open", "pulse_ms": pulse_ms, "superseded": not done}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/door/close")
-def door_close(
+async def door_close(
     body: Optional[PulseRequest] = None,
     ms: int = Query(None, ge=1, le=5000)
 ):
-    pulse_ms = ms or (body.ms if body and body.ms else None) or DEFAULT_PULSE_MS
+    pulse_ms = ms or (body.ms if body and body.ms else None) or CFG.default_pulse_ms
     try:
-        manager.pulse("close", pulse_ms)
-        return {"ok": True, "action": "close", "pulse_ms": pulse_ms}
+        done = await manager.pulse("close", pulse_ms)
+        return {"ok": True, "action": "close", "pulse_ms": pulse_ms, "superseded": not done}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/door/hold")
-def door_hold(target: Literal["open", "close"]):
+async def door_hold(target: Literal["open", "close"]):
     try:
-        manager.hold(target)
+        await manager.hold(target)
         return {"ok": True, "action": f"hold_{target}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+_STOP_BODY = orjson.dumps({"ok": True, "action": "stop"})
+
+
 @app.post("/door/stop")
-def door_stop():
-    manager.stop()
-    return {"ok": True, "action": "stop"}
+async def door_stop():
+    await manager.stop()
+    return Response(_STOP_BODY, media_type="application/json")
+
+
+# ส่วนที่ไม่เปลี่ยนของ /limit/status
+_LIMIT_INFO = {
+    "input": "DI1",
+    "gpio_line": CFG.line_di1,
+    "active_high": CFG.di1_active_high,
+    "debounce_ms": CFG.di1_debounce_ms,
+}
 
 
 @app.get("/limit/status")
-def limit_status():
+async def limit_status():
+    # di1.read() คืนค่าที่ cache ไว้ ไม่ block -> รันบน event loop ได้เลย
     state = di1.read()
     return {
         "ok": True,
         "limit": {
-            "input": "DI1",
-            "gpio_line": LINE_DI1,
-            "active_high": DI1_ACTIVE_HIGH,
-            "debounce_ms": DI1_DEBOUNCE_MS,
+            **_LIMIT_INFO,
             "state": "ON" if state else "OFF",
             "value": int(state),
         },
@@ -204,204 +360,346 @@ def limit_status():
 # =========================================================
 # Sensor (RS485 + Dew Point)
 # =========================================================
-SERIAL_PORT = os.getenv("SERIAL_PORT", "/dev/ttyACM0")
-BAUDRATE = int(os.getenv("BAUDRATE", "9600"))
-PARITY = os.getenv("PARITY", "N")
-BYTESIZE = int(os.getenv("BYTESIZE", "8"))
-STOPBITS = int(os.getenv("STOPBITS", "1"))
-TIMEOUT_S = float(os.getenv("TIMEOUT_S", "1.0"))
-
-READ_TABLE = os.getenv("READ_TABLE", "holding").lower()  # holding | input
-REG_START = int(os.getenv("REG_START", "0"))
-REG_COUNT = int(os.getenv("REG_COUNT", "2"))
-
-TEMP_INDEX = int(os.getenv("TEMP_INDEX", "1"))
-HUMI_INDEX = int(os.getenv("HUMI_INDEX", "0"))
-SCALE_DIV = float(os.getenv("SCALE_DIV", "10"))
-
-INDOOR_ID = int(os.getenv("INDOOR_ID", "1"))
-OUTDOOR_ID = int(os.getenv("OUTDOOR_ID", "2"))
-
-POLL_MS = int(os.getenv("POLL_MS", "1000"))
-
-modbus = ModbusSerialClient(
-    port=SERIAL_PORT,
-    baudrate=BAUDRATE,
-    bytesize=BYTESIZE,
-    parity=PARITY,
-    stopbits=STOPBITS,
-    timeout=TIMEOUT_S,
-)
+# error code สั้นๆ สำหรับ hot path (poll loop / WS) ข้อความเต็มสร้างเฉพาะตอนตอบ REST
+ERR_MODBUS_DISCONNECT = 1
+ERR_MODBUS_IO = 2
+ERR_SHORT_REGS = 3
+ERR_MODBUS_TIMEOUT = 4
+
+_ERR_TEXT = {
+    ERR_MODBUS_DISCONNECT: "Modbus not connected",
+    ERR_MODBUS_IO: "Modbus Error",
+    ERR_SHORT_REGS: "Modbus short response",
+    ERR_MODBUS_TIMEOUT: "Modbus timeout",
+}
+
+
+class ModbusError(RuntimeError):
+    def __init__(self, code: int, unit_id: int):
+        # ไม่ format ข้อความตอนสร้าง: รอบ poll ที่ bus มีปัญหาใช้แค่ code
+        super().__init__(code, unit_id)
+        self.code = code
+        self.unit_id = unit_id
+
+    def __str__(self) -> str:
+        return f"{_ERR_TEXT.get(self.code, 'Modbus failure')} (unit {self.unit_id})"
+
+
+_modbus: Optional[AsyncModbusSerialClient] = None
+
+
+def _get_client() -> AsyncModbusSerialClient:
+    # สร้างตอนใช้ครั้งแรก: import module แล้วยังไม่แตะ serial device
+    global _modbus
+    if _modbus is None:
+        _modbus = AsyncModbusSerialClient(
+            port=CFG.serial_port,
+            baudrate=CFG.baudrate,
+            bytesize=CFG.bytesize,
+            parity=CFG.parity,
+            stopbits=CFG.stopbits,
+            timeout=CFG.timeout_s,
+            retries=CFG.modbus_retries,
+        )
+    return _modbus
 
-_modbus_lock = threading.Lock()
 
+# RS485 เป็น single master: ให้มี transaction บน bus ได้ทีละครั้ง
+_modbus_lock = asyncio.Lock()
 
-def ensure_connected():
-    with _modbus_lock:
-        if not modbus.connected:
-            if not modbus.connect():
-                raise RuntimeError("Modbus not connected")
+# เพดานเวลาต่อ transaction (safety net เท่านั้น): ต้องนานกว่าที่ pymodbus
+# รอครบทุก retry เอง ไม่อย่างนั้นจะตัดกลางรอบ retry แล้ว reply ที่มาช้าไปชน request ถัดไป
+_REQUEST_CAP_S = CFG.timeout_s * (CFG.modbus_retries + 1) + 0.5
 
 
-def read_raw_regs(unit_id: int) -> Tuple[int, ...]:
-    ensure_connected()
-    with _modbus_lock:
-        if READ_TABLE == "input":
-            rr = modbus.read_input_registers(REG_START, REG_COUNT, slave=unit_id)
-        else:
-            rr = modbus.read_holding_registers(REG_START, REG_COUNT, slave=unit_id)
+async def _request_regs(modbus: AsyncModbusSerialClient, unit_id: int):
+    if CFG.read_table == "input":
+        req = modbus.read_input_registers(CFG.reg_start, CFG.reg_count, slave=unit_id)
+    else:
+        req = modbus.read_holding_registers(CFG.reg_start, CFG.reg_count, slave=unit_id)
+    try:
+        return await asyncio.wait_for(req, _REQUEST_CAP_S)
+    except (asyncio.TimeoutError, ModbusIOException):
+        # pymodbus raise ModbusIOException เมื่อไม่มีคำตอบติดกันหลายครั้ง (แล้วปิด connection)
+        raise ModbusError(ERR_MODBUS_TIMEOUT, unit_id)
+
+
+async def _read_regs_locked(unit_id: int) -> List[int]:
+    # ต้องถือ _modbus_lock อยู่แล้ว
+    # พอร์ตเปิดค้างไว้ตั้งแต่ startup; reconnect เฉพาะตอนหลุดจริง
+    modbus = _get_client()
+    try:
+        rr = await _request_regs(modbus, unit_id)
+    except ConnectionException:
+        modbus.close()
+        if not await modbus.connect():
+            raise ModbusError(ERR_MODBUS_DISCONNECT, unit_id)
+        rr = await _request_regs(modbus, unit_id)
     if rr.isError():
-        raise RuntimeError(f"Modbus Error: {rr}")
-    return tuple(rr.registers)
+        # ไม่มีคำตอบครบ retry: pymodbus คืน ExceptionResponse ที่ exception_code = 0
+        if getattr(rr, "exception_code", None) == 0:
+            raise ModbusError(ERR_MODBUS_TIMEOUT, unit_id)
+        raise ModbusError(ERR_MODBUS_IO, unit_id)
+    regs = rr.registers
+    if len(regs) < CFG.reg_count:
+        raise ModbusError(ERR_SHORT_REGS, unit_id)
+    # ใช้ list ของ pymodbus ตรงๆ ไม่ต้อง copy เป็น tuple
+    return regs
+
+
+async def read_raw_regs(unit_id: int) -> List[int]:
+    async with _modbus_lock:
+        return await _read_regs_locked(unit_id)
+
+
+async def read_raw_regs_multi(units: List[int]) -> Dict[int, Any]:
+    """
+    อ่านหลาย unit ต่อกันใน lock เดียว
+    unit ที่อ่านไม่ได้จะได้ Exception แทน list ของ registers
+    """
+    out: Dict[int, Any] = {}
+    port_gone = False
+    async with _modbus_lock:
+        for unit_id in units:
+            if port_gone:
+                # reconnect ไม่ขึ้นแล้วรอบนี้ ไม่ต้อง close/connect ซ้ำทุก unit
+                out[unit_id] = ModbusError(ERR_MODBUS_DISCONNECT, unit_id)
+                continue
+            try:
+                out[unit_id] = await _read_regs_locked(unit_id)
+            except Exception as e:
+                out[unit_id] = e
+                port_gone = isinstance(e, ModbusError) and e.code == ERR_MODBUS_DISCONNECT
+    return out
 
 
-# def to_humi_temp(regs: Tuple[int, ...]) -> Tuple[float, float]:
-#     humi = regs[HUMI_INDEX] / SCALE_DIV
-#     temp = regs[TEMP_INDEX] / SCALE_DIV
-#     return humi, temp
+async def connect_modbus() -> bool:
+    async with _modbus_lock:
+        return await _get_client().connect()
 
-def to_humi_temp(regs):
-    humi = regs[HUMI_INDEX] / SCALE_DIV
-    temp = regs[TEMP_INDEX] / SCALE_DIV
+
+def to_humi_temp(regs: List[int]) -> Tuple[float, float]:
+    humi = regs[CFG.humi_index] / CFG.scale_div
+    temp = regs[CFG.temp_index] / CFG.scale_div
     return humi, temp
 
 
+def round1(x: float) -> float:
+    """
+    ปัดทศนิยม 1 ตำแหน่ง (half-up) ด้วย float/int math แทน round(x, 1) ที่ผ่าน dtoa
+    """
+    if not math.isfinite(x):
+        return x
+    return math.floor(x * 10.0 + 0.5) / 10.0
+
+
+# Magnus constants (คำนวณครั้งเดียวตอน import)
+_MAGNUS_A = 17.62
+_MAGNUS_B = 243.12
+_LN_INV100 = math.log(0.01)
+
+
 def calc_dewpoint(temp_c: float, rh: float) -> float:
     """
     Dew point (°C) using Magnus formula
     """
     if rh <= 0:
         return float("nan")
-    a = 17.62
-    b = 243.12
-    gamma = math.log(rh / 100.0) + (a * temp_c) / (b + temp_c)
-    return (b * gamma) / (a - gamma)
+    gamma = math.log(rh) + _LN_INV100 + (_MAGNUS_A * temp_c) / (_MAGNUS_B + temp_c)
+    return (_MAGNUS_B * gamma) / (_MAGNUS_A - gamma)
+
+
+def unit_entry(unit_id: int, regs: List[int]) -> Dict[str, Any]:
+    h, t = to_humi_temp(regs)
+    d = calc_dewpoint(t, h)
+    return {
+        "unit_id": unit_id,
+        "raw": regs,
+        "humi": round1(h),
+        "temp": round1(t),
+        "dewpoint": round1(d),
+    }
+
 
+# snapshot ล่าสุดจาก sensor_poll_loop (producer เดียว)
+# REST/WS อ่านจากตรงนี้ ไม่ยิง Modbus เองต่อ request
+latest: Dict[str, Any] = {"ts": 0, "ok": False, "indoor": None, "outdoor": None}
+sensor_fresh = asyncio.Event()
 
-@app.get("/api/sensor/{unit_id}")
-def read_sensor_unit(unit_id: int):
+
+async def get_snapshot(max_age_ms: Optional[int] = None) -> Dict[str, Any]:
+    snap = latest
+    if max_age_ms is not None and time.time_ns() // 1_000_000 - snap["ts"] > max_age_ms:
+        # รอรอบ poll ถัดไป (ไม่เกิน 1 รอบ + เวลาอ่านสอง unit)
+        try:
+            await asyncio.wait_for(
+                sensor_fresh.wait(), CFG.poll_ms / 1000.0 + 2 * _REQUEST_CAP_S
+            )
+        except asyncio.TimeoutError:
+            pass
+        snap = latest
+    return snap
+
+
+@app.get("/api/sensor/{unit_id}", response_class=ORJSONResponse)
+async def read_sensor_unit(unit_id: int, max_age_ms: Optional[int] = Query(None, ge=0)):
+    name = "indoor" if unit_id == CFG.indoor_id else (
+        "outdoor" if unit_id == CFG.outdoor_id else f"unit_{unit_id}"
+    )
     try:
-        regs = read_raw_regs(unit_id)
-        humi, temp = to_humi_temp(regs)
-        dew = calc_dewpoint(temp, humi)
-        name = "indoor" if unit_id == INDOOR_ID else (
-            "outdoor" if unit_id == OUTDOOR_ID else f"unit_{unit_id}"
-        )
+        if unit_id in (CFG.indoor_id, CFG.outdoor_id):
+            snap = await get_snapshot(max_age_ms)
+            # poll ที่พังทั้งรอบมีแค่ "error" ไม่มี key ของ unit
+            entry = snap.get(name)
+            if entry is None:
+                raise RuntimeError(snap.get("error") or "no sensor data yet")
+            if "error_code" in entry:
+                raise ModbusError(entry["error_code"], unit_id)
+            ts = snap["ts"]
+        else:
+            # unit อื่นที่ไม่อยู่ใน poll loop -> อ่านสด
+            entry = unit_entry(unit_id, await read_raw_regs(unit_id))
+            ts = time.time_ns() // 1_000_000
         return {
             "ok": True,
             "name": name,
             "unit_id": unit_id,
-            "raw_registers": regs,
-            "humi": round(humi, 1),
-            "temp": round(temp, 1),
-            "dewpoint": round(dew, 1),
+            "ts": ts,
+            "raw_registers": entry["raw"],
+            "humi": entry["humi"],
+            "temp": entry["temp"],
+            "dewpoint": entry["dewpoint"],
         }
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"ok": False, "unit_id": unit_id, "error": str(e)}
         )
 
 
-@app.get("/api/sensor")
-def read_sensor_both():
-    out: Dict[str, Any] = {"ok": True}
-
-    try:
-        r1 = read_raw_regs(INDOOR_ID)
-        h1, t1 = to_humi_temp(r1)
-        d1 = calc_dewpoint(t1, h1)
-        out["indoor"] = {
-            "unit_id": INDOOR_ID,
-            "raw": r1,
-            "humi": round(h1, 1),
-            "temp": round(t1, 1),
-            "dewpoint": round(d1, 1),
-        }
-    except Exception as e:
-        out["indoor"] = {"unit_id": INDOOR_ID, "error": str(e)}
-        out["ok"] = False
-
-    try:
-        r2 = read_raw_regs(OUTDOOR_ID)
-        h2, t2 = to_humi_temp(r2)
-        d2 = calc_dewpoint(t2, h2)
-        out["outdoor"] = {
-            "unit_id": OUTDOOR_ID,
-            "raw": r2,
-            "humi": round(h2, 1),
-            "temp": round(t2, 1),
-            "dewpoint": round(d2, 1),
-        }
-    except Exception as e:
-        out["outdoor"] = {"unit_id": OUTDOOR_ID, "error": str(e)}
-        out["ok"] = False
-
+@app.get("/api/sensor", response_class=ORJSONResponse)
+async def read_sensor_both(max_age_ms: Optional[int] = Query(None, ge=0)):
+    snap = await get_snapshot(max_age_ms)
+    if snap["ok"]:
+        return snap
+    # snapshot เก็บแค่ error_code; REST ใส่ข้อความเต็มให้ (สร้างเฉพาะตอนมี error)
+    out = dict(snap)
+    for label in ("indoor", "outdoor"):
+        entry = snap.get(label)
+        if entry and "error_code" in entry:
+            out[label] = {
+                **entry,
+                "error": str(ModbusError(entry["error_code"], entry["unit_id"])),
+            }
     return out
 
 
 # =========================================================
 # WebSocket Sensor Realtime
 # =========================================================
-ws_clients: Set[WebSocket] = set()
+# แต่ละ connection มี queue ของตัวเอง (เก็บแค่ frame ล่าสุด)
+# client ช้าจะตกหล่น frame เก่าเอง โดยไม่ถ่วง poll loop
+ws_queues: List[asyncio.Queue] = []
 
 
-@app.websocket("/ws/sensor")
-async def ws_sensor(ws: WebSocket):
-    await ws.accept()
-    ws_clients.add(ws)
+def publish_ws(msg: str):
+    for q in ws_queues:
+        if q.full():
+            q.get_nowait()
+        q.put_nowait(msg)
+
+
+async def _ws_sender(ws: WebSocket, q: asyncio.Queue):
+    while True:
+        msg = await q.get()
+        # client ที่ปิดไปแล้วแต่ยังไม่ถูกเก็บกวาด: จบเลยโดยไม่ต้องลองส่ง
+        if ws.client_state != WebSocketState.CONNECTED:
+            return
+        await asyncio.wait_for(ws.send_text(msg), CFG.ws_send_timeout_s)
+
+
+async def _ws_receiver(ws: WebSocket):
     try:
         while True:
             await ws.receive_text()
     except WebSocketDisconnect:
         pass
+
+
+@app.websocket("/ws/sensor")
+async def ws_sensor(ws: WebSocket):
+    await ws.accept()
+    q: asyncio.Queue = asyncio.Queue(maxsize=1)
+    ws_queues.append(q)
+    tasks = [
+        asyncio.create_task(_ws_sender(ws, q)),
+        asyncio.create_task(_ws_receiver(ws)),
+    ]
+    try:
+        # จบเมื่อ client ปิด หรือส่งไม่ทัน/ส่งไม่ได้
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
     finally:
-        ws_clients.discard(ws)
+        ws_queues.remove(q)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await ws.close()
+        except Exception:
+            pass
 
 
 async def sensor_poll_loop():
+    period_s = CFG.poll_ms / 1000.0
+    next_deadline = time.monotonic()
+    global latest
     while True:
-        payload = {"ts": int(time.time() * 1000), "ok": True}
-
-        def pack(unit_id: int):
-            regs = read_raw_regs(unit_id)
-            h, t = to_humi_temp(regs)
-            d = calc_dewpoint(t, h)
-            return {
-                "unit_id": unit_id,
-                "temp": round(t, 1),
-                "humi": round(h, 1),
-                "dewpoint": round(d, 1),
-            }
+        payload: Dict[str, Any] = {"ts": time.time_ns() // 1_000_000, "ok": True}
 
         try:
-            payload["indoor"] = pack(INDOOR_ID)
-            payload["outdoor"] = pack(OUTDOOR_ID)
+            regs_by_unit = await read_raw_regs_multi([CFG.indoor_id, CFG.outdoor_id])
+            for label, unit_id in (("indoor", CFG.indoor_id), ("outdoor", CFG.outdoor_id)):
+                regs = regs_by_unit[unit_id]
+                if isinstance(regs, Exception):
+                    payload[label] = {
+                        "unit_id": unit_id,
+                        "error_code": regs.code if isinstance(regs, ModbusError) else ERR_MODBUS_IO,
+                    }
+                    payload["ok"] = False
+                    continue
+                payload[label] = unit_entry(unit_id, regs)
         except Exception as e:
             payload["ok"] = False
             payload["error"] = str(e)
 
-        dead = []
-        for ws in ws_clients:
-            try:
-                await ws.send_json(payload)
-            except Exception:
-                dead.append(ws)
+        # สลับ snapshot ทั้งก้อน (reader ไม่เห็นครึ่งๆ กลางๆ) แล้วปลุกคนที่รอ
+        latest = payload
+        sensor_fresh.set()
+        sensor_fresh.clear()
 
-        for ws in dead:
-            ws_clients.discard(ws)
+        # encode ครั้งเดียว แล้วแจก text เดียวกันให้ทุก client
+        publish_ws(orjson.dumps(payload).decode())
 
-        await asyncio.sleep(POLL_MS / 1000.0)
+        # นับรอบจาก deadline (monotonic) ไม่ใช่ต่อท้ายเวลาทำงาน -> cadence คงที่
+        next_deadline += period_s
+        delay = next_deadline - time.monotonic()
+        if delay < 0:
+            # bus ช้าจนตกรอบ: ตั้ง deadline ใหม่จากตอนนี้ ไม่ยิงรัวเพื่อไล่รอบที่หายไป
+            next_deadline = time.monotonic()
+            delay = 0.0
+        await asyncio.sleep(delay)
 
 
 @app.on_event("startup")
 async def startup_event():
+    await connect_modbus()
     asyncio.create_task(sensor_poll_loop())
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     try:
-        modbus.close()
+        if _modbus is not None:
+            _modbus.close()
     except Exception:
         pass
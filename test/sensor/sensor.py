@@ -1,8 +1,11 @@
-import os, time, asyncio
+import os, time, asyncio, threading
+from contextlib import asynccontextmanager
+from email.utils import formatdate
 from typing import List, Tuple, Dict, Any
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
+import orjson
 
 from pymodbus.client import ModbusSerialClient  # RTU/Serial
 
@@ -26,6 +29,7 @@ INDOOR_ID     = int(os.getenv("INDOOR_ID", "1"))
 OUTDOOR_ID    = int(os.getenv("OUTDOOR_ID", "2"))
 
 POLL_MS       = int(os.getenv("POLL_MS", "1000"))
+CACHE_TTL_S   = float(os.getenv("CACHE_TTL_S", "0.25"))  # live read ของ unit อื่นที่ถามถี่ๆ ใช้ค่าเดียวกัน
 
 # ===== Modbus client (RTU over /dev/ttyACM0) =====
 client = ModbusSerialClient(
@@ -38,7 +42,13 @@ client = ModbusSerialClient(
     timeout=TIMEOUT_S,
 )
 
-app = FastAPI(title="RS485 Temp&Humi API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(poll_loop())
+    yield
+    task.cancel()
+
+app = FastAPI(title="RS485 Temp&Humi API", default_response_class=ORJSONResponse, lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 
@@ -48,95 +58,172 @@ def ensure_connected() -> None:
         if not client.connect():
             raise RuntimeError("Modbus not connected")
 
-def read_raw_regs(unit: int, address: int | None = None, count: int | None = None) -> Tuple[int, ...]:
-    ensure_connected()
+# ผลอ่านล่าสุดต่อ unit: (monotonic ts, registers)
+_cache: Dict[int, Tuple[float, Tuple[int, ...]]] = {}
+# endpoint sync รันบน threadpool -> กันทั้ง cache และ bus (client ไม่ thread-safe)
+_bus_lock = threading.Lock()
+
+def read_raw_regs(unit: int, address: int | None = None, count: int | None = None,
+                  use_cache: bool = True) -> Tuple[int, ...]:
+    # cache เฉพาะช่วง register ปกติ (ไม่ได้ระบุ address/count เอง)
+    # poll_all_units อ่านสดเสมอ (use_cache=False) ไม่อย่างนั้น POLL_MS < CACHE_TTL_S จะได้ค่าเก่าซ้ำ
+    cacheable = use_cache and address is None and count is None
     addr = REG_START if address is None else address
     cnt  = REG_COUNT if count   is None else count
 
-    if READ_TABLE == "input":
-        rr = client.read_input_registers(addr, cnt, slave=unit)   # FC04
-    else:
-        rr = client.read_holding_registers(addr, cnt, slave=unit) # FC03
-    if rr.isError():
-        raise RuntimeError(f"Modbus error (unit {unit}): {rr}")
-    return tuple(rr.registers)
+    with _bus_lock:
+        if cacheable:
+            ts, regs = _cache.get(unit, (0.0, None))
+            if regs is not None and time.monotonic() - ts < CACHE_TTL_S:
+                return regs
+
+        ensure_connected()
+        if READ_TABLE == "input":
+            rr = client.read_input_registers(addr, cnt, slave=unit)   # FC04
+        else:
+            rr = client.read_holding_registers(addr, cnt, slave=unit) # FC03
+        if rr.isError():
+            raise RuntimeError(f"Modbus error (unit {unit}): {rr}")
+        regs = tuple(rr.registers)
+        if cacheable:
+            _cache[unit] = (time.monotonic(), regs)
+        return regs
+
+# จำนวน register ขั้นต่ำ คำนวณครั้งเดียวจาก env
+_NEED = max(HUMI_INDEX, TEMP_INDEX) + 1
 
 def to_humi_temp(regs: List[int] | Tuple[int, ...]) -> Tuple[float, float]:
-    need = max(HUMI_INDEX, TEMP_INDEX) + 1
-    if len(regs) < need:
-        raise ValueError(f"Need at least {need} registers, got {len(regs)}")
+    if len(regs) < _NEED:
+        raise ValueError(f"Need at least {_NEED} registers, got {len(regs)}")
     humi = regs[HUMI_INDEX] / SCALE_DIV
     temp = regs[TEMP_INDEX] / SCALE_DIV
     return humi, temp
 
+# ===== Snapshot (poll ครั้งเดียว ใช้ร่วมกันทั้ง REST และ WS) =====
+# ก่อน poll รอบแรกเสร็จ ให้ REST เห็นว่ายังไม่มีข้อมูล (ไม่แตะ bus เอง)
+latest_snapshot: Dict[str, Any] = {
+    "ts": 0, "ok": False,
+    "indoor": {"unit_id": INDOOR_ID, "error": "no sensor data yet"},
+    "outdoor": {"unit_id": OUTDOOR_ID, "error": "no sensor data yet"},
+}
+_snapshot_mono = time.monotonic()
+
+def poll_all_units() -> Dict[str, Any]:
+    """อ่านทุก unit หนึ่งรอบ แล้วสลับ snapshot ทั้งก้อน (dict swap เป็น atomic)"""
+    global latest_snapshot, _snapshot_mono
+    payload = {"ts": time.time_ns() // 1_000_000, "ok": True}
+
+    def pack(unit_id: int, label: str):
+        try:
+            regs = read_raw_regs(unit=unit_id, use_cache=False)
+            h, t = to_humi_temp(regs)
+            payload[label] = {"unit_id": unit_id, "raw": regs, "humi": h, "temp": t}
+        except Exception as e:
+            payload[label] = {"unit_id": unit_id, "error": str(e)}
+            payload["ok"] = False
+
+    pack(INDOOR_ID, "indoor")
+    pack(OUTDOOR_ID, "outdoor")
+
+    latest_snapshot = payload
+    _snapshot_mono = time.monotonic()
+    return payload
+
+def get_snapshot() -> Tuple[Dict[str, Any], int]:
+    # REST ไม่อ่าน bus เอง: bus ช้า/sensor ตาย ก็ได้ snapshot เดิมพร้อมอายุ (ms) ไป
+    return latest_snapshot, int((time.monotonic() - _snapshot_mono) * 1000)
+
 # ===== REST =====
 @app.get("/api/sensor/{unit_id}")
 def read_sensor_unit(unit_id: int) -> Dict[str, Any]:
+    name = "indoor" if unit_id == INDOOR_ID else ("outdoor" if unit_id == OUTDOOR_ID else f"unit_{unit_id}")
     try:
-        regs = read_raw_regs(unit=unit_id)
-        humi, temp = to_humi_temp(regs)
-        name = "indoor" if unit_id == INDOOR_ID else ("outdoor" if unit_id == OUTDOOR_ID else f"unit_{unit_id}")
+        if unit_id in (INDOOR_ID, OUTDOOR_ID):
+            snap, age_ms = get_snapshot()
+            entry = snap[name]
+            if "error" in entry:
+                raise RuntimeError(entry["error"])
+            regs, humi, temp = entry["raw"], entry["humi"], entry["temp"]
+        else:
+            # unit อื่นที่ไม่อยู่ใน poll -> อ่านสด
+            regs = read_raw_regs(unit=unit_id)
+            humi, temp = to_humi_temp(regs)
+            age_ms = 0
         return {
             "ok": True, "name": name, "unit_id": unit_id, "table": READ_TABLE,
             "start": REG_START, "count": REG_COUNT,
             "raw_registers": regs,
-            "humi": round(humi, 1), "temp": round(temp, 1),
+            "humi": humi, "temp": temp, "age_ms": age_ms,
         }
     except Exception as e:
-        return JSONResponse(status_code=500, content={"ok": False, "error": str(e), "unit_id": unit_id})
+        return ORJSONResponse(status_code=500, content={"ok": False, "error": str(e), "unit_id": unit_id})
 
 @app.get("/api/sensor")
-def read_sensor_both() -> Dict[str, Any]:
-    out = {"ok": True, "table": READ_TABLE, "start": REG_START, "count": REG_COUNT, "indoor": None, "outdoor": None}
-    try:
-        regs1 = read_raw_regs(unit=INDOOR_ID); h1, t1 = to_humi_temp(regs1)
-        out["indoor"] = {"raw": regs1, "humi": round(h1,1), "temp": round(t1,1), "unit_id": INDOOR_ID}
-    except Exception as e:
-        out["indoor"] = {"error": str(e), "unit_id": INDOOR_ID}; out["ok"] = False
-    try:
-        regs2 = read_raw_regs(unit=OUTDOOR_ID); h2, t2 = to_humi_temp(regs2)
-        out["outdoor"] = {"raw": regs2, "humi": round(h2,1), "temp": round(t2,1), "unit_id": OUTDOOR_ID}
-    except Exception as e:
-        out["outdoor"] = {"error": str(e), "unit_id": OUTDOOR_ID}; out["ok"] = False
-    return out
+def read_sensor_both(request: Request):
+    snap, age_ms = get_snapshot()
+    # snapshot เปลี่ยนเฉพาะตอน poll -> ใช้ ts เป็น ETag; client ที่ถามถี่กว่า poll ได้ 304 ไม่ต้อง encode
+    etag = f'"{snap["ts"]}"'
+    # อายุ snapshot เปลี่ยนทุก request -> ส่งเป็น header Age (วินาที) ไม่ใส่ใน body ที่ ETag คุมอยู่
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(snap["ts"] / 1000, usegmt=True),
+        "Age": str(age_ms // 1000),
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(
+        {"ok": True, "table": READ_TABLE, "start": REG_START, "count": REG_COUNT, **snap},
+        headers=headers,
+    )
 
 # ===== WebSocket realtime =====
-clients: set[WebSocket] = set()
+# แต่ละ client มี queue + sender task ของตัวเอง
+# poll_loop แค่ put_nowait (ทิ้งของเก่าเมื่อเต็ม) -> client ช้าไม่ถ่วงการอ่าน sensor
+client_queues: Dict[WebSocket, asyncio.Queue] = {}
+WS_QUEUE_MAX = 16
+
+def publish(payload: Dict[str, Any]) -> None:
+    if not client_queues:
+        return
+    # encode ครั้งเดียวต่อรอบ; ส่งเป็น text frame เพราะหน้าเว็บ JSON.parse(e.data)
+    msg = orjson.dumps(payload).decode()
+    for q in client_queues.values():
+        if q.full():
+            q.get_nowait()
+        q.put_nowait(msg)
+
+async def ws_sender(ws: WebSocket, q: asyncio.Queue) -> None:
+    try:
+        while True:
+            msg = await q.get()
+            await ws.send_text(msg)
+    except Exception:
+        pass
+    finally:
+        client_queues.pop(ws, None)
 
 async def poll_loop():
     while True:
-        payload = {"ts": int(time.time()*1000), "ok": True}
-
-        def pack(unit_id: int, label: str):
-            try:
-                regs = read_raw_regs(unit=unit_id)
-                h, t = to_humi_temp(regs)
-                return {label: {"unit_id": unit_id, "raw": list(regs), "humi": round(h,1), "temp": round(t,1)}}
-            except Exception as e:
-                return {label: {"unit_id": unit_id, "error": str(e)}}
-
-        payload.update(pack(INDOOR_ID, "indoor"))
-        payload.update(pack(OUTDOOR_ID, "outdoor"))
-        if "error" in payload["indoor"] or "error" in payload["outdoor"]:
-            payload["ok"] = False
+        # pymodbus sync client block: อ่านใน thread ไม่ให้ถ่วง event loop (WS/HTTP ยังวิ่งได้)
+        payload = await asyncio.to_thread(poll_all_units)
 
-        stale = []
-        for ws in clients:
-            try: await ws.send_json(payload)
-            except Exception: stale.append(ws)
-        for ws in stale: clients.discard(ws)
+        publish(payload)
 
         await asyncio.sleep(POLL_MS/1000)
 
-@app.on_event("startup")
-async def startup_event():
-    await ws.accept(); clients.add(ws)
+@app.websocket("/ws")
+async def ws_endpoint(ws: WebSocket):
+    await ws.accept()
+    q: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+    client_queues[ws] = q
+    sender = asyncio.create_task(ws_sender(ws, q))
     try:
         while True: await ws.receive_text()
     except WebSocketDisconnect:
         pass
     finally:
-        clients.discard(ws)
+        client_queues.pop(ws, None)
+        sender.cancel()
 
 @app.get("/")
 def root():
@@ -1,10 +1,15 @@
 import os
 import time
 import math
-import requests
+import signal
+import asyncio
+from collections import deque
 from datetime import datetime, timezone
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+import aiohttp
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from influxdb_client.rest import ApiException
 
 SENSOR_API_URL = os.getenv("SENSOR_API_URL", "http://naritcm-lidar-api:8000/api/sensor")
 POLL_SEC = float(os.getenv("POLL_SEC", "1.0"))
@@ -15,72 +20,232 @@ INFLUX_TOKEN = os.getenv("INFLUX_TOKEN", "")
 INFLUX_ORG = os.getenv("INFLUX_ORG", "Narit")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "Lidar")
 MEASUREMENT = os.getenv("MEASUREMENT", "room1")
+# write พลาดติดกันกี่ครั้งถึงจะทิ้ง client แล้วสร้างใหม่ (connection อาจค้าง/หลุด)
+INFLUX_MAX_FAILS = int(os.getenv("INFLUX_MAX_FAILS", "5"))
+
+# buffer ฝั่ง writer: flush เมื่อครบ FLUSH_SIZE บรรทัด หรือทุก FLUSH_SEC
+FLUSH_SIZE = int(os.getenv("FLUSH_SIZE", "500"))
+FLUSH_SEC = float(os.getenv("FLUSH_SEC", "5.0"))
+# Influx ล่มนานๆ เก็บไว้ได้เท่านี้ เกินแล้วทิ้งของเก่าสุด
+BUFFER_MAX = int(os.getenv("BUFFER_MAX", "10000"))
+# Influx เขียนไม่ได้: รอก่อนลองใหม่ เริ่มที่ FLUSH_SEC แล้วเพิ่มเท่าตัวจนถึงค่านี้
+FLUSH_RETRY_MAX_SEC = float(os.getenv("FLUSH_RETRY_MAX_SEC", "60.0"))
+
+# Influx ปฏิเสธตัวข้อมูลเอง (line ผิด / ใหญ่เกิน / นอก retention): ส่งซ้ำก็ไม่ผ่าน -> ทิ้ง batch
+# 401/403/404 (token/bucket) เป็นปัญหา config แก้แล้วส่งต่อได้ จึงยัง retry ตามปกติ
+_DROP_STATUS = frozenset((400, 413, 422))
+
+LOCATIONS = ("indoor", "outdoor")
+
+# line protocol prefix (measurement + tags) คงที่ต่อ location -> สร้างครั้งเดียว
+_LP_MEASUREMENT = MEASUREMENT.replace(",", "\\,").replace(" ", "\\ ")
+_LP_PREFIX = {loc: f"{_LP_MEASUREMENT},location={loc} " for loc in LOCATIONS}
+
+# Magnus constants (คำนวณครั้งเดียวตอน import)
+_MAGNUS_A = 17.62
+_MAGNUS_B = 243.12
+_LN_INV100 = math.log(0.01)
 
 def dewpoint_c(temp_c: float, rh: float) -> float:
-    # Magnus formula
-    a, b = 17.62, 243.12
-    rh = max(0.1, min(100.0, float(rh)))
-    t = float(temp_c)
-    gamma = math.log(rh / 100.0) + (a * t) / (b + t)
-    return (b * gamma) / (a - gamma)
+    # Magnus formula; caller ส่ง float มาแล้ว clamp ด้วย compare ไม่ต้องเรียก max/min
+    rh = 0.1 if rh < 0.1 else (100.0 if rh > 100.0 else rh)
+    gamma = math.log(rh) + _LN_INV100 + (_MAGNUS_A * temp_c) / (_MAGNUS_B + temp_c)
+    return (_MAGNUS_B * gamma) / (_MAGNUS_A - gamma)
 
 def now_ns() -> int:
-    return int(time.time() * 1e9)
+    return time.time_ns()
+
+async def fetch_sensor(session: aiohttp.ClientSession) -> dict:
+    async with session.get(SENSOR_API_URL) as r:
+        r.raise_for_status()
+        return await r.json()
 
-def fetch_sensor() -> dict:
-    r = requests.get(SENSOR_API_URL, timeout=TIMEOUT_SEC)
-    r.raise_for_status()
-    return r.json()
+def build_lines(data: dict, ts: int) -> list:
+    lines = []
 
-def main():
+    for loc in LOCATIONS:
+        d = data.get(loc)
+        # รองรับทั้ง format ใหม่ที่มี dewpoint และ format เก่าที่ไม่มี
+        # entry ที่ error / ไม่มีค่า (None, ไม่มี key, ไม่ใช่ตัวเลข) ข้ามไป
+        try:
+            temp = float(d["temp"])
+            humi = float(d["humi"])
+            if "dewpoint" not in d:
+                # format เก่าที่ไม่มี dewpoint -> คำนวณเอง
+                dp = dewpoint_c(temp, humi)
+            else:
+                # API ส่ง NaN มาเป็น null (เช่น rh <= 0) -> ข้าม field นี้ ไม่คำนวณทับ
+                dp = d["dewpoint"]
+                dp = math.nan if dp is None else float(dp)
+        except (KeyError, TypeError, ValueError):
+            continue
+        # NaN/inf ใช้ใน line protocol ไม่ได้ (float() รับ "nan"/"inf" ด้วย)
+        if not (math.isfinite(temp) and math.isfinite(humi)):
+            continue
+
+        fields = f"temp={temp},humi={humi}"
+        # dewpoint ที่คำนวณไม่ได้ข้ามแค่ field นี้ (Point เดิมก็ข้าม field ที่ไม่ finite)
+        if math.isfinite(dp):
+            fields += f",dewpoint={dp}"
+        lines.append(f"{_LP_PREFIX[loc]}{fields} {ts}")
+
+    return lines
+
+# client + write_api ตัวเดียวใช้ทุกรอบ (HTTP connection เดิม) จนกว่าจะพังติดกัน
+_influx = None
+_write_fails = 0
+
+def get_write_api():
+    global _influx
+    if _influx is None:
+        client = InfluxDBClientAsync(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
+        _influx = (client, client.write_api())
+    return _influx[1]
+
+async def reset_influx() -> None:
+    global _influx
+    if _influx is not None:
+        client, _ = _influx
+        _influx = None
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+def _is_rejected(e: Exception) -> bool:
+    return isinstance(e, ApiException) and e.status in _DROP_STATUS
+
+async def write_lines(lines: list) -> None:
+    global _write_fails
+    try:
+        await get_write_api().write(
+            bucket=INFLUX_BUCKET,
+            org=INFLUX_ORG,
+            record=lines,
+            write_precision=WritePrecision.NS,
+        )
+    except Exception as e:
+        # server ตอบปกติ แค่ไม่รับข้อมูล -> ไม่นับเป็น connection พัง
+        if not _is_rejected(e):
+            _write_fails += 1
+            if _write_fails >= INFLUX_MAX_FAILS:
+                # รอบหน้า get_write_api() จะสร้าง client/connection ใหม่
+                await reset_influx()
+                _write_fails = 0
+        raise
+    _write_fails = 0
+
+async def sleep_or_stop(stop: asyncio.Event, sec: float) -> None:
+    try:
+        await asyncio.wait_for(stop.wait(), sec)
+    except asyncio.TimeoutError:
+        pass
+
+async def flush(buf: deque) -> None:
+    if not buf:
+        return
+    lines = list(buf)
+    buf.clear()
+    try:
+        await write_lines(lines)
+    except Exception as e:
+        if _is_rejected(e):
+            # ส่งซ้ำก็ไม่ผ่าน -> ทิ้ง batch นี้ ไม่ค้าง buffer ไว้
+            print(f"influx rejected batch of {len(lines)} lines (HTTP {e.status}): {e.message or e.reason}; dropped",
+                  flush=True)
+            return
+        # เขียนไม่ได้: คืนเข้า buffer ข้างหน้า (เท่าที่ยังมีที่ เก็บชุดใหม่กว่าไว้) รอรอบหน้า
+        room = buf.maxlen - len(buf)
+        if room > 0:
+            buf.extendleft(reversed(lines[-room:]))
+        raise
+
+async def producer(session: aiohttp.ClientSession, buf: deque,
+                   flush_now: asyncio.Event, stop: asyncio.Event) -> None:
+    backoff = 1.0
+    last_ts = None
+    try:
+        while not stop.is_set():
+            try:
+                data = await fetch_sensor(session)
+
+                # API ตอบจาก snapshot ที่ poll ทุก POLL_MS: ใช้ ts ของ snapshot (เวลาที่อ่าน sensor จริง)
+                # และข้าม snapshot ที่เขียนไปแล้ว ไม่ให้ค่าเดียวกันซ้ำด้วย timestamp ต่างกัน
+                ts_ms = data.get("ts")
+                if ts_ms is None:
+                    # API รุ่นเก่าที่ไม่มี ts
+                    ts = now_ns()
+                elif ts_ms == last_ts:
+                    ts = None
+                else:
+                    last_ts = ts_ms
+                    ts = int(ts_ms) * 1_000_000
+
+                if ts is not None:
+                    # เก็บเป็น line protocol สำเร็จรูป ไม่ต้องแปลงอีกตอน flush
+                    buf.extend(build_lines(data, ts))
+                    if len(buf) >= FLUSH_SIZE:
+                        flush_now.set()
+
+                backoff = 1.0
+                await sleep_or_stop(stop, POLL_SEC)
+
+            except Exception as e:
+                # กันล้ม: ถ้า API มีปัญหา จะหน่วงแล้วลองใหม่
+                await sleep_or_stop(stop, backoff)
+                backoff = min(backoff * 2.0, 30.0)
+    finally:
+        # ปลุก consumer ให้ flush รอบสุดท้ายแล้วจบ
+        flush_now.set()
+
+async def consumer(buf: deque, flush_now: asyncio.Event, stop: asyncio.Event) -> None:
+    retry_sec = 0.0  # > 0 ระหว่างที่ Influx เขียนไม่ได้
+    while not stop.is_set():
+        if retry_sec:
+            # กำลัง backoff: ไม่ตื่นตาม flush_now (buffer เกิน FLUSH_SIZE จะ set ทุกรอบ poll)
+            await sleep_or_stop(stop, retry_sec)
+        else:
+            try:
+                await asyncio.wait_for(flush_now.wait(), FLUSH_SEC)
+            except asyncio.TimeoutError:
+                pass
+        if stop.is_set():
+            break
+        flush_now.clear()
+        try:
+            await flush(buf)
+            retry_sec = 0.0
+        except Exception:
+            # Influx มีปัญหา: ข้อมูลยังอยู่ใน buffer ลองใหม่หลัง backoff
+            retry_sec = min(retry_sec * 2.0, FLUSH_RETRY_MAX_SEC) if retry_sec else FLUSH_SEC
+
+    try:
+        await flush(buf)
+    except Exception:
+        pass
+
+async def main():
     if not INFLUX_TOKEN:
         raise SystemExit("INFLUX_TOKEN is empty. Please set it in docker-compose.yml environment.")
 
-    client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-    write_api = client.write_api()
+    # docker stop ส่ง SIGTERM -> จบ loop, flush ที่ค้าง แล้วปิด session/client ให้เรียบร้อย
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
 
-    backoff = 1.0
-    while True:
+    buf: deque = deque(maxlen=BUFFER_MAX)
+    flush_now = asyncio.Event()
+
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT_SEC)
+    # ClientSession เดียว = keep-alive กับ API ตลอด, I/O ทั้งหมดไม่ block thread
+    async with aiohttp.ClientSession(timeout=timeout) as session:
         try:
-            data = fetch_sensor()
-
-            ts = now_ns()
-            points = []
-
-            for loc in ("indoor", "outdoor"):
-                d = data.get(loc) or {}
-                if not isinstance(d, dict):
-                    continue
-
-                # รองรับทั้ง format ใหม่ที่มี dewpoint และ format เก่าที่ไม่มี
-                temp = d.get("temp")
-                humi = d.get("humi")
-
-                if isinstance(temp, (int, float)) and isinstance(humi, (int, float)):
-                    dp = d.get("dewpoint")
-                    if not isinstance(dp, (int, float)):
-                        dp = dewpoint_c(temp, humi)
-
-                    p = (
-                        Point(MEASUREMENT)
-                        .tag("location", loc)
-                        .field("temp", float(temp))
-                        .field("humi", float(humi))
-                        .field("dewpoint", float(dp))
-                        .time(ts, WritePrecision.NS)
-                    )
-                    points.append(p)
-
-            if points:
-                write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=points)
-
-            backoff = 1.0
-            time.sleep(POLL_SEC)
-
-        except Exception as e:
-            # กันล้ม: ถ้า API หรือ Influx มีปัญหา จะหน่วงแล้วลองใหม่
-            time.sleep(backoff)
-            backoff = min(backoff * 2.0, 30.0)
+            # อ่าน sensor กับเขียน Influx แยก task กัน: write ช้าไม่ถ่วงรอบ poll
+            await asyncio.gather(
+                producer(session, buf, flush_now, stop),
+                consumer(buf, flush_now, stop),
+            )
+        finally:
+            await reset_influx()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())